@@ -1125,12 +1125,13 @@ class PackageInfo:
         # shared packages.  This will allow different packages
         # installed in different directories to share Python files as
         # if they were all in the same directory.
+        initExtensions = set(['py'] + VFSImporter.compiledExtensions)
         for filename in mf.getSubfileNames():
-            if filename.endswith('/__init__.pyc') or \
-               filename.endswith('/__init__.pyo') or \
-               filename.endswith('/__init__.py'):
-                components = filename.split('/')[:-1]
-                moduleName = '.'.join(components)
+            if '/__init__.' not in filename:
+                continue
+            dirname, ext = filename.rsplit('/__init__.', 1)
+            if ext in initExtensions:
+                moduleName = dirname.replace('/', '.')
                 VFSImporter.sharedPackages[moduleName] = True
 
         # Fix up any shared directories so we can load packages from
@@ -1,12 +1,25 @@
 __all__ = ['register', 'sharedPackages',
-           'reloadSharedPackage', 'reloadSharedPackages']
+           'reloadSharedPackage', 'reloadSharedPackages',
+           'invalidate_caches']
 
-from panda3d.core import Filename, VirtualFileSystem, VirtualFileMountSystem, OFileStream, copyStream
+from panda3d.core import Filename, VirtualFileSystem, VirtualFileMountSystem, VirtualFileMountMultifile, OFileStream, copyStream
 from direct.stdpy.file import open
+
+# Note that everything we need must be imported up front, even modules
+# like marshal which are only used when reading or writing .pyc
+# files.  Importing them lazily from within the loader would mean
+# importing a module in the middle of importing a module, which could
+# recurse right back into the loader before the first import is done.
+# This module is also frozen into p3dpython and imported before any
+# multifile is mounted, so it should stick to builtin modules; modules
+# like struct that need a separate shared library are not available.
 import sys
+import os
+import atexit
 import marshal
 import imp
 import types
+import weakref
 
 # The sharedPackages dictionary lists all of the "shared packages",
 # special Python packages that automatically span multiple directories
@@ -31,6 +44,55 @@ if not __debug__:
     # We implement that by reversing the extension names.
     compiledExtensions = [ 'pyo', 'pyc' ]
 
+# These don't change while the process is running, so we only need to
+# query them once.
+_PYC_MAGIC = imp.get_magic()
+
+# The size of the header at the start of a .pyc file, and the offset of
+# the source timestamp within it.  The header starts with the magic
+# number.  Since Python 3.7 (see PEP 552), this is followed by a flags
+# field, then the timestamp, and then the size of the source file.
+# Python 3.0 - 3.6 don't have the flags field, and Python 2 has neither
+# the flags nor the size.
+if sys.version_info >= (3, 7):
+    _PYC_HEADER_SIZE = 16
+    _PYC_TIMESTAMP_OFFSET = 8
+elif sys.version_info >= (3, 0):
+    _PYC_HEADER_SIZE = 12
+    _PYC_TIMESTAMP_OFFSET = 4
+else:
+    _PYC_HEADER_SIZE = 8
+    _PYC_TIMESTAMP_OFFSET = 4
+_C_SUFFIXES = tuple(desc for desc in imp.get_suffixes()
+                    if desc[2] == imp.C_EXTENSION)
+
+# The suffixes of all of the files that may make up a module.
+_MODULE_SUFFIXES = ('.py', '.pyc', '.pyo') + \
+                   tuple(desc[0] for desc in _C_SUFFIXES)
+
+# Extension modules that exist only in the VFS have to be written out
+# to a temporary file before they can be loaded.  This maps the
+# (filename, timestamp) of each such module to the temporary file we
+# wrote it to, so that we don't extract it again if it is reimported.
+_extractedModules = {}
+
+def _removeExtractedModules():
+    # Note that this doesn't work on Windows, which won't delete a DLL
+    # while it is still loaded, as these will be until the very end.
+    for filename in _extractedModules.values():
+        filename.unlink()
+    _extractedModules.clear()
+
+atexit.register(_removeExtractedModules)
+
+# The maximum number of failed lookups that each VFSImporter will
+# remember.
+_MAX_MISSES = 1024
+
+# All of the VFSImporter objects currently in existence, so that
+# invalidate_caches() can reach each of their caches.
+_importers = weakref.WeakSet()
+
 class VFSImporter:
     """ This class serves as a Python importer to support loading
     Python .py and .pyc/.pyo files from Panda's Virtual File System,
@@ -43,65 +105,228 @@ class VFSImporter:
         else:
             self.dir_path = Filename.fromOsSpecific(path)
 
+        # The names that we have recently failed to find, each mapped
+        # to a counter value recording when it was last looked up.
+        # Programs may try to import any number of modules that don't
+        # exist, so this is kept to a bounded size.
+        self._misses = {}
+        self._missCounter = 0
+
+        # The names of the files within dir_path, and the state of the
+        # file system when they were listed; see _getDirEntries().
+        self._dir_entries = None
+        self._dir_state = None
+        _importers.add(self)
+
+    def invalidate_caches(self):
+        """ Forgets the results of all previous lookups, so that files
+        that have been added or removed since are noticed.  Most
+        changes are noticed anyway, since they change the timestamp of
+        the directory, but that timestamp has a resolution of only one
+        second; a file that is added within the same second as a
+        previous lookup will be missed without this. """
+        self._misses.clear()
+        self._dir_entries = None
+        self._dir_state = None
+
     def find_module(self, fullname, path = None):
-        if path is None:
-            dir_path = self.dir_path
-        else:
-            dir_path = path
+        if path is not None:
+            # Searching a different directory than our own.  It's not
+            # worth listing it for a single lookup, so we just ask the
+            # VFS about each candidate filename.
+            return self._find_module(fullname, path, None)
+
+        # This also throws away the recorded misses if the directory
+        # might have changed since they were recorded.
+        entries = self._getDirEntries()
+
+        # We don't remember the modules we do find, since a new loader
+        # must be made each time to pick up the current timestamps;
+        # otherwise, reloading a module that has been edited would
+        # just run the old code again.
+        if fullname in self._misses:
+            # Mark it as recently used, so it will be the last to go.
+            self._missCounter += 1
+            self._misses[fullname] = self._missCounter
+            return None
+
+        loader = self._find_module(fullname, self.dir_path, entries)
+        if not loader and entries is not None and \
+           not _isListed(entries, fullname.split('.')[-1]):
+            # We only remember the miss if the listing alone ruled the
+            # module out.  If we had to ask the VFS, the answer may
+            # change without the timestamp of this directory changing;
+            # for instance, when pkg/__init__.py is created.
+            self._missCounter += 1
+            self._misses[fullname] = self._missCounter
+            if len(self._misses) > _MAX_MISSES:
+                self._trimMisses()
+        return loader
+
+    def _trimMisses(self):
+        """ Forgets the least recently looked-up failed lookups, so
+        that only three quarters of _MAX_MISSES remain.  Trimming a
+        batch at a time keeps the cost of sorting low. """
+
+        # Finders aren't called under a global lock on Python 3, so
+        # another thread may be trimming at the same time as this one;
+        # names may disappear from under us.
+        misses = self._misses
+        names = sorted(misses, key = lambda name: misses.get(name, 0))
+        for name in names[:len(names) - _MAX_MISSES * 3 // 4]:
+            misses.pop(name, None)
+
+    def _getDirEntries(self):
+        """ Returns the set of names of the files within dir_path.
+        Testing a candidate filename against this set is much cheaper
+        than asking the VFS about it, especially when the directory is
+        within a multifile.  The set is only used to rule candidates
+        out, though; a name that does appear is still looked up with
+        vfs.getFile(), which applies the precedence of the mounts and
+        finds implicitly-compressed .pz files.
+
+        Returns None if dir_path is not a directory that can be listed;
+        it may not exist, or it may be a multifile that will only be
+        mounted when a file within it is requested, if vfs-implicit-mf
+        is set.  In this case, every candidate has to be looked up.
+
+        The listing, along with the recorded misses, is thrown away
+        whenever a mount is added or removed, or the timestamp of the
+        directory itself changes. """
+
+        dir_path = self.dir_path
+        if dir_path.empty():
+            dir_path = Filename('.')
+
+        dir_vfile = vfs.getFile(dir_path, True)
+
+        # Directories within a multifile have no timestamp of their own;
+        # asking for the one at the root of the mount even trips an
+        # assertion.  Files added to a multifile while it is mounted
+        # are therefore only noticed after invalidate_caches().
+        timestamp = None
+        if dir_vfile and not (hasattr(dir_vfile, 'getMount') and \
+           isinstance(dir_vfile.getMount(), VirtualFileMountMultifile)):
+            timestamp = dir_vfile.getTimestamp()
+
+        state = (vfs.getMountSeq(), timestamp)
+        if state != self._dir_state:
+            self._misses.clear()
+            entries = None
+            if dir_vfile and dir_vfile.isDirectory():
+                entries = set()
+                for vfile in dir_vfile.scanDirectory() or []:
+                    name = vfile.getFilename().getBasename()
+                    entries.add(name)
+                    if name.endswith('.pz'):
+                        # vfs.getFile() will find foo.py.pz when it is
+                        # asked for foo.py.
+                        entries.add(name[:-3])
+            self._dir_entries = entries
+            self._dir_state = state
+
+        return self._dir_entries
+
+    def _find_module(self, fullname, dir_path, entries):
+        """ Looks for the named module within dir_path.  entries is
+        the set of names in that directory, as returned by
+        _getDirEntries(), or None if it hasn't been listed. """
+
         #print >>sys.stderr, "find_module(%s), dir_path = %s" % (fullname, dir_path)
         basename = fullname.split('.')[-1]
         path = Filename(dir_path, basename)
+        base = path.getFullpath()
 
         # First, look for Python files.
-        filename = Filename(path)
-        filename.setExtension('py')
-        vfile = vfs.getFile(filename, True)
+        filename, vfile = _probe(entries, basename, base, '.py', True)
         if vfile:
+            pycVfile = None
+            for ext in compiledExtensions:
+                pycFilename, pycVfile = _probe(entries, basename, base,
+                                               '.' + ext, False)
+                if pycVfile:
+                    break
+
             return VFSLoader(dir_path, vfile, filename,
-                             desc=('.py', 'U', imp.PY_SOURCE))
+                             desc=('.py', 'U', imp.PY_SOURCE),
+                             pycVfile=pycVfile)
 
         # If there's no .py file, but there's a .pyc file, load that
         # anyway.
         for ext in compiledExtensions:
-            filename = Filename(path)
-            filename.setExtension(ext)
-            vfile = vfs.getFile(filename, True)
+            filename, vfile = _probe(entries, basename, base, '.' + ext, False)
             if vfile:
                 return VFSLoader(dir_path, vfile, filename,
-                                 desc=('.'+ext, 'rb', imp.PY_COMPILED))
+                                 desc=('.'+ext, 'rb', imp.PY_COMPILED),
+                                 pycVfile=vfile)
 
         # Look for a C/C++ extension module.
-        for desc in imp.get_suffixes():
-            if desc[2] != imp.C_EXTENSION:
-                continue
-
-            filename = Filename(path + desc[0])
-            vfile = vfs.getFile(filename, True)
+        for desc in _C_SUFFIXES:
+            filename, vfile = _probe(entries, basename, base, desc[0], True)
             if vfile:
                 return VFSLoader(dir_path, vfile, filename, desc=desc)
 
         # Finally, consider a package, i.e. a directory containing
         # __init__.py.
+        if entries is not None and basename not in entries:
+            #print >>sys.stderr, "not found."
+            return None
+
         filename = Filename(path, '__init__.py')
         vfile = vfs.getFile(filename, True)
         if vfile:
+            pycVfile = None
+            for ext in compiledExtensions:
+                pycVfile = vfs.getFile(Filename(path, '__init__.' + ext), False)
+                if pycVfile:
+                    break
+
             return VFSLoader(dir_path, vfile, filename, packagePath=path,
-                             desc=('.py', 'U', imp.PY_SOURCE))
+                             desc=('.py', 'U', imp.PY_SOURCE),
+                             pycVfile=pycVfile)
         for ext in compiledExtensions:
             filename = Filename(path, '__init__.' + ext)
-            vfile = vfs.getFile(filename, True)
+            vfile = vfs.getFile(filename, False)
             if vfile:
                 return VFSLoader(dir_path, vfile, filename, packagePath=path,
-                                 desc=('.'+ext, 'rb', imp.PY_COMPILED))
+                                 desc=('.'+ext, 'rb', imp.PY_COMPILED),
+                                 pycVfile=vfile)
 
         #print >>sys.stderr, "not found."
         return None
 
+def _isListed(entries, basename):
+    """ Returns true if any of the files or directories that could make
+    up the module basename appear in entries, the set returned by
+    VFSImporter._getDirEntries(). """
+
+    if basename in entries:
+        return True
+    for suffix in _MODULE_SUFFIXES:
+        if basename + suffix in entries:
+            return True
+    return False
+
+def _probe(entries, basename, base, suffix, statusOnly):
+    """ Looks up the file named base + suffix, whose basename is
+    basename + suffix, and returns a (Filename, VirtualFile) pair; the
+    VirtualFile is None if the file does not exist.  If entries is not
+    None, it is the set returned by VFSImporter._getDirEntries(), and
+    names that don't appear in it are ruled out without asking the
+    VFS. """
+
+    if entries is not None and basename + suffix not in entries:
+        return None, None
+
+    filename = Filename(base + suffix)
+    return filename, vfs.getFile(filename, statusOnly)
+
 class VFSLoader:
     """ The second part of VFSImporter, this is created for a
     particular .py file or directory. """
 
-    def __init__(self, dir_path, vfile, filename, desc, packagePath=None):
+    def __init__(self, dir_path, vfile, filename, desc, packagePath=None,
+                 pycVfile=None):
         self.dir_path = dir_path
         self.timestamp = None
         if vfile:
@@ -110,6 +335,13 @@ class VFSLoader:
         self.desc = desc
         self.packagePath = packagePath
 
+        # The compiled file that goes with this .py file, if the
+        # importer found one.  For a .pyc file, this is the file itself.
+        self._pycVfile = pycVfile
+        self._pycTimestamp = None
+        if pycVfile:
+            self._pycTimestamp = pycVfile.getTimestamp()
+
     def load_module(self, fullname, loadingShared = False):
         #print >>sys.stderr, "load_module(%s), dir_path = %s, filename = %s" % (fullname, self.dir_path, self.filename)
         if self.desc[2] == imp.PY_FROZEN:
@@ -171,10 +403,19 @@ class VFSLoader:
            self.desc[2] == imp.C_EXTENSION:
             return None
 
-        filename = Filename(self.filename)
-        filename.setExtension('py')
-        filename.setText()
-        return open(self.filename, self.desc[1]).read()
+        # vfs.getFile() finds foo.py.pz when it is asked for foo.py, but
+        # it is up to us to ask for the file to be decompressed.
+        vfile = vfs.getFile(self.filename)
+        if not vfile:
+            raise IOError("Could not find '%s'" % (self.filename))
+        sin = vfile.openReadFile(True)
+        if not sin:
+            raise IOError("Could not open '%s'" % (self.filename))
+        try:
+            with open(sin, self.desc[1]) as f:
+                return f.read()
+        finally:
+            vfile.closeReadFile(sin)
 
     def _import_extension_module(self, fullname):
         """ Loads the binary shared object as a Python module, and
@@ -197,26 +438,46 @@ class VFSLoader:
             filename = self.filename
         else:
             # It's a virtual file with no real-world existence.  Dump
-            # it to disk.  TODO: clean up this filename.
-            filename = Filename.temporary('', self.filename.getBasenameWoExtension(),
-                                          '.' + self.filename.getExtension(),
-                                          type = Filename.TDso)
-            filename.setExtension(self.filename.getExtension())
-            filename.setBinary()
-            sin = vfile.openReadFile(True)
-            sout = OFileStream()
-            if not filename.openWrite(sout):
-                raise IOError
-            if not copyStream(sin, sout):
-                raise IOError
-            vfile.closeReadFile(sin)
-            del sout
+            # it to disk, unless we have already done so.
+            key = (self.filename.getFullpath(), vfile.getTimestamp())
+            filename = _extractedModules.get(key, None)
+            if filename is None or not filename.exists():
+                filename = self._extract_extension_module(vfile)
+                _extractedModules[key] = filename
 
         module = imp.load_module(fullname, None, filename.toOsSpecific(),
                                  self.desc)
         module.__file__ = self.filename.toOsSpecific()
         return module
 
+    def _extract_extension_module(self, vfile):
+        """ Writes the contents of the indicated virtual file to a
+        temporary file on disk, and returns its filename.  We try to
+        remove the file again when the process exits. """
+
+        filename = Filename.temporary('', self.filename.getBasenameWoExtension(),
+                                      '.' + self.filename.getExtension(),
+                                      type = Filename.TDso)
+        filename.setExtension(self.filename.getExtension())
+        filename.setBinary()
+        sout = OFileStream()
+        if not filename.openWrite(sout):
+            raise IOError
+        sin = vfile.openReadFile(True)
+        copied = False
+        try:
+            copied = copyStream(sin, sout)
+        finally:
+            vfile.closeReadFile(sin)
+            sout.close()
+            if not copied:
+                # Don't leave a partial copy lying around.
+                filename.unlink()
+
+        if not copied:
+            raise IOError
+        return filename
+
     def _import_frozen_module(self, fullname):
         """ Imports the frozen module without messing around with
         searching any more. """
@@ -237,62 +498,54 @@ class VFSLoader:
 
         if self.desc[2] == imp.PY_COMPILED:
             # It's a pyc file; just read it directly.
-            pycVfile = vfs.getFile(self.filename, False)
-            if pycVfile:
-                return self._loadPyc(pycVfile, None)
-            raise IOError('Could not read %s' % (self.filename))
+            return self._loadPyc(self._pycVfile, None)
 
         elif self.desc[2] == imp.C_EXTENSION:
             return None
 
         # It's a .py file (or an __init__.py file; same thing).  Read
         # the .pyc file if it is available and current; otherwise read
-        # the .py file and compile it.
-        t_pyc = None
-        for ext in compiledExtensions:
-            pycFilename = Filename(self.filename)
-            pycFilename.setExtension(ext)
-            pycVfile = vfs.getFile(pycFilename, False)
-            if pycVfile:
-                t_pyc = pycVfile.getTimestamp()
-                break
-
-        code = None
+        # the .py file and compile it.  find_module() has already
+        # looked for the .pyc file.
+        t_pyc = self._pycTimestamp
         if t_pyc and t_pyc >= self.timestamp:
             try:
-                code = self._loadPyc(pycVfile, self.timestamp)
+                return self._loadPyc(self._pycVfile, self.timestamp)
             except ValueError:
-                code = None
+                pass
 
-        if not code:
-            source = self._read_source()
-            filename = Filename(self.filename)
-            filename.setExtension('py')
-            code = self._compile(filename, source)
-
-        return code
+        source = self._read_source()
+        return self._compile(self.filename, source)
 
     def _loadPyc(self, vfile, timestamp):
         """ Reads and returns the marshal data from a .pyc file.
         Raises ValueError if there is a problem. """
 
-        code = None
         data = vfile.readFile(True)
-        if data[:4] != imp.get_magic():
+        if len(data) < _PYC_HEADER_SIZE or data[:4] != _PYC_MAGIC:
             raise ValueError("Bad magic number in %s" % (vfile))
 
+        # Unmarshal straight out of the buffer we read, rather than
+        # slicing off the header, which would copy the whole thing.
+        i = _PYC_TIMESTAMP_OFFSET
         if sys.version_info >= (3, 0):
-            t = int.from_bytes(data[4:8], 'little')
-            data = data[12:]
+            t = int.from_bytes(data[i:i + 4], 'little')
+            body = memoryview(data)[_PYC_HEADER_SIZE:]
         else:
-            t = ord(data[4]) + (ord(data[5]) << 8) + \
-               (ord(data[6]) << 16) + (ord(data[7]) << 24)
-            data = data[8:]
+            t = ord(data[i]) + (ord(data[i + 1]) << 8) + \
+               (ord(data[i + 2]) << 16) + (ord(data[i + 3]) << 24)
+            body = buffer(data, _PYC_HEADER_SIZE)
 
-        if not timestamp or t == timestamp:
-            return marshal.loads(data)
-        else:
-            raise ValueError("Timestamp wrong on %s" % (vfile))
+        if timestamp:
+            if sys.version_info >= (3, 7) and data[4:8] != b'\0\0\0\0':
+                # It's a hash-based .pyc file, which has a hash of the
+                # source in place of the timestamp.  We don't check
+                # those, so we treat it as out of date.
+                raise ValueError("Not timestamp-based: %s" % (vfile))
+            if t != timestamp:
+                raise ValueError("Timestamp wrong on %s" % (vfile))
+
+        return marshal.loads(body)
 
 
     def _compile(self, filename, source):
@@ -300,32 +553,127 @@ class VFSLoader:
         attempts to write it to an appropriate .pyc file.  May raise
         SyntaxError or other errors generated by the compiler. """
 
-        if source and source[-1] != '\n':
-            source = source + '\n'
-        code = compile(source, filename.toOsSpecific(), 'exec')
+        code = compile(source, filename.toOsSpecific(), 'exec',
+                       dont_inherit=True)
 
-        # try to cache the compiled code
-        pycFilename = Filename(filename)
-        pycFilename.setExtension(compiledExtensions[0])
+        # Try to cache the compiled code.  We write it to a temporary
+        # file and then move that into place, so that nobody else can
+        # ever see a partially-written .pyc file.
+        if sys.version_info >= (3, 0):
+            # Python 3 also has a field for the size of the source
+            # file.  We don't check it, so we leave it zero.  We also
+            # leave the flags zero on Python 3.7, which marks this as
+            # a timestamp-based .pyc file.
+            header = _PYC_MAGIC
+            if sys.version_info >= (3, 7):
+                header += b'\0\0\0\0'
+            header += (self.timestamp & 0xffffffff).to_bytes(4, 'little') + \
+                b'\0\0\0\0'
+        else:
+            header = _PYC_MAGIC + \
+                chr(self.timestamp & 0xff) + \
+                chr((self.timestamp >> 8) & 0xff) + \
+                chr((self.timestamp >> 16) & 0xff) + \
+                chr((self.timestamp >> 24) & 0xff)
+
+        pycPath = filename.getFullpathWoExtension() + '.' + compiledExtensions[0]
+        pycFilename = Filename(pycPath)
+
+        # The temporary filename must be unique to this process and this
+        # compile, or two processes compiling the same module at once
+        # could move each other's partially-written files into place.
+        tempFilename = Filename('%s.%s.%s.tmp' % (pycPath, os.getpid(), id(code)))
         try:
-            f = open(pycFilename.toOsSpecific(), 'wb')
+            f = open(tempFilename.toOsSpecific(), 'xb')
         except IOError:
-            pass
+            # We can't create the file; perhaps the directory isn't
+            # writable.  Never mind.
+            return code
+
+        try:
+            with f:
+                f.write(header)
+                f.write(marshal.dumps(code))
+        except IOError:
+            vfs.deleteFile(tempFilename)
         else:
-            f.write(imp.get_magic())
-            if sys.version_info >= (3, 0):
-                f.write((self.timestamp & 0xffffffff).to_bytes(4, 'little'))
-                f.write(b'\0\0\0\0')
-            else:
-                f.write(chr(self.timestamp & 0xff) +
-                        chr((self.timestamp >> 8) & 0xff) +
-                        chr((self.timestamp >> 16) & 0xff) +
-                        chr((self.timestamp >> 24) & 0xff))
-            f.write(marshal.dumps(code))
-            f.close()
+            if not vfs.renameFile(tempFilename, pycFilename):
+                vfs.deleteFile(tempFilename)
 
         return code
 
+class VFSMetaFinder:
+    """ This is added onto the meta_path list, so that it is called
+    before sys.path is traversed.  It walks the search path itself,
+    asking the same importers that Python would have found via
+    path_hooks, and so it can return as soon as any one of them locates
+    the module.  Whenever it comes across a path entry that is not
+    handled by a VFSImporter, it gives up and lets Python do the search
+    instead, so that the search order is preserved. """
+
+    def find_module(self, fullname, path = None):
+        #print >>sys.stderr, "meta find_module(%s), path = %s" % (fullname, path)
+
+        if imp.is_frozen(fullname):
+            # Let Python load frozen modules the usual way.
+            return None
+
+        if path is None:
+            if imp.is_builtin(fullname):
+                # Don't let a file on sys.path shadow a builtin module.
+                return None
+            path = sys.path
+
+        elif isinstance(path, (str, type(u''))):
+            # Python 2 sets the __path__ of a frozen package to its own
+            # name.  There's nothing sensible for us to search.
+            return None
+
+        for dir in path:
+            if dir == '' and sys.version_info >= (3, 0):
+                # Python 3 searches the current directory at the time of
+                # the import for this entry, giving modules an absolute
+                # __file__, so we must do the same.
+                try:
+                    dir = os.getcwd()
+                except OSError:
+                    # The current directory has been deleted.
+                    continue
+
+            importer = self._getImporter(dir)
+            if not isinstance(importer, VFSImporter):
+                # This entry is handled by some other importer (or by
+                # none at all); let Python take it from here.
+                return None
+
+            loader = importer.find_module(fullname)
+            if loader:
+                return loader
+
+        return None
+
+    def _getImporter(self, dir):
+        """ Returns the importer for the indicated path entry, found
+        the same way Python would find it: from sys.path_importer_cache
+        if it is there, or else from the first hook on sys.path_hooks
+        that accepts the entry. """
+
+        try:
+            return sys.path_importer_cache[dir]
+        except KeyError:
+            pass
+
+        importer = None
+        for hook in sys.path_hooks:
+            try:
+                importer = hook(dir)
+                break
+            except ImportError:
+                continue
+
+        sys.path_importer_cache[dir] = importer
+        return importer
+
 class VFSSharedImporter:
     """ This is a special importer that is added onto the meta_path
     list, so that it is called before sys.path is traversed.  It uses
@@ -472,15 +820,17 @@ class VFSSharedLoader:
 
 _registered = False
 def register():
-    """ Register the VFSImporter on the path_hooks, if it has not
-    already been registered, so that future Python import statements
-    will vector through here (and therefore will take advantage of
-    Panda's virtual file system). """
+    """ Register the VFSImporter on the path_hooks, and the
+    VFSMetaFinder and VFSSharedImporter on the meta_path, if they have
+    not already been registered, so that future Python import
+    statements will vector through here (and therefore will take
+    advantage of Panda's virtual file system). """
 
     global _registered
     if not _registered:
         _registered = True
         sys.path_hooks.insert(0, VFSImporter)
+        sys.meta_path.insert(0, VFSMetaFinder())
         sys.meta_path.insert(0, VFSSharedImporter())
 
         # Blow away the importer cache, so we'll come back through the
@@ -488,6 +838,18 @@ def register():
         # folders that previously were loaded directly.
         sys.path_importer_cache = {}
 
+def invalidate_caches():
+    """ Clears the lookup caches of all VFSImporter objects.  Mounting
+    or unmounting files on the virtual file system is noticed anyway,
+    as is any change to a directory on sys.path that updates its
+    timestamp.  However, that timestamp only has a resolution of one
+    second, so this must be called after adding a file to a directory
+    that may have been searched within the same second, to ensure that
+    subsequent imports will see it. """
+
+    for importer in list(_importers):
+        importer.invalidate_caches()
+
 def reloadSharedPackage(mod):
     """ Reloads the specific module as a shared package, adding any
     new directories that might have appeared on the search path. """
@@ -522,6 +884,10 @@ def reloadSharedPackages():
 
     #print >> sys.stderr, "reloadSharedPackages, path = %s, sharedPackages = %s" % (sys.path, sharedPackages.keys())
 
+    # This is typically called after new directories have been mounted,
+    # so make sure we don't hang onto any stale lookup results.
+    invalidate_caches()
+
     # Sort the list, just to make sure parent packages are reloaded
     # before child packages are.
     for fullname in sorted(sharedPackages.keys()):
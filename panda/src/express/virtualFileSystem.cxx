@@ -423,6 +423,19 @@ get_mount(int n) const {
   return result;
 }
 
+/**
+ * Returns a number that is incremented every time a mount is added to or
+ * removed from the system.  Code that caches the results of file lookups may
+ * use this to detect when those results might have become stale.
+ */
+unsigned int VirtualFileSystem::
+get_mount_seq() const {
+  _lock.lock();
+  unsigned int result = _mount_seq;
+  _lock.unlock();
+  return result;
+}
+
 /**
  * Changes the current directory.  This is used to resolve relative pathnames
  * in get_file() and/or find_file().  Returns true if successful, false
@@ -1331,7 +1344,9 @@ consider_mount_mf(const Filename &filename) {
     // Reached the top directory; no .mf file references.
     return false;
   }
-  if (is_directory(dirname)) {
+  // We already hold the lock, so we can't use is_directory() here.
+  PT(VirtualFile) dir_file = do_get_file(dirname, OF_status_only);
+  if (dir_file != nullptr && dir_file->is_directory()) {
     // Reached a real (or already-mounted) directory; no unmounted .mf file
     // references.
     return false;
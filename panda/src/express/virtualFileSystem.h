@@ -62,6 +62,7 @@ PUBLISHED:
   PT(VirtualFileMount) get_mount(int n) const;
   MAKE_SEQ(get_mounts, get_num_mounts, get_mount);
   MAKE_SEQ_PROPERTY(mounts, get_num_mounts, get_mount);
+  unsigned int get_mount_seq() const;
 
   BLOCKING bool chdir(const Filename &new_directory);
   BLOCKING Filename get_cwd() const;
@@ -0,0 +1,377 @@
+import os
+import sys
+import imp
+import zlib
+import py_compile
+import pytest
+from panda3d import core
+from direct.showbase import VFSImporter
+
+
+vfs = core.VirtualFileSystem.get_global_ptr()
+
+
+@pytest.fixture
+def mount_point(tmpdir):
+    """ Returns a virtual directory onto which multifiles may be mounted,
+    and unmounts them again afterwards. """
+    point = core.Filename.from_os_specific(str(tmpdir.join('mnt')))
+    yield point
+    vfs.unmount_point(point)
+
+
+def make_multifile(tmpdir, name, files):
+    """ Writes a multifile containing the given {subfile name: data} and
+    returns its filename. """
+    src = tmpdir.mkdir(name + '-src')
+    mf_path = core.Filename.from_os_specific(str(tmpdir.join(name + '.mf')))
+    mf = core.Multifile()
+    assert mf.open_write(mf_path)
+    for subfile_name, data in files.items():
+        path = src.join(subfile_name)
+        path.write_binary(data, ensure=True)
+        filename = core.Filename.from_os_specific(str(path))
+        filename.set_binary()
+        mf.add_subfile(subfile_name, filename, 0)
+    mf.close()
+    return mf_path
+
+
+def mount(tmpdir, mount_point, name, files):
+    mf_path = make_multifile(tmpdir, name, files)
+    assert vfs.mount(mf_path, mount_point, core.VirtualFileSystem.MF_read_only)
+
+
+def load(importer, fullname):
+    loader = importer.find_module(fullname)
+    assert loader is not None
+    try:
+        return loader.load_module(fullname)
+    finally:
+        sys.modules.pop(fullname, None)
+
+
+def test_import_from_multifile(tmpdir, mount_point):
+    mount(tmpdir, mount_point, 'a', {'vfsimp_mf_mod.py': b'value = 1\n'})
+
+    importer = VFSImporter.VFSImporter(mount_point)
+    mod = load(importer, 'vfsimp_mf_mod')
+    assert mod.value == 1
+
+
+def test_import_package_from_multifile(tmpdir, mount_point):
+    mount(tmpdir, mount_point, 'a', {
+        'vfsimp_mf_pkg/__init__.py': b'value = 2\n',
+    })
+
+    importer = VFSImporter.VFSImporter(mount_point)
+    mod = load(importer, 'vfsimp_mf_pkg')
+    assert mod.value == 2
+    assert len(mod.__path__) == 1
+
+
+def test_new_mount_is_noticed(tmpdir, mount_point):
+    importer = VFSImporter.VFSImporter(mount_point)
+    assert importer.find_module('vfsimp_late_mod') is None
+
+    # Mounting something should be noticed without any further action.
+    mount(tmpdir, mount_point, 'a', {'vfsimp_late_mod.py': b'value = 3\n'})
+    mod = load(importer, 'vfsimp_late_mod')
+    assert mod.value == 3
+
+
+def test_invalidate_caches(tmpdir, mount_point):
+    mount(tmpdir, mount_point, 'a', {'vfsimp_other_mod.py': b''})
+    importer = VFSImporter.VFSImporter(mount_point)
+    assert importer.find_module('vfsimp_inval_mod') is None
+    assert 'vfsimp_inval_mod' in importer._misses
+
+    mount(tmpdir, mount_point, 'b', {'vfsimp_inval_mod.py': b'value = 4\n'})
+    VFSImporter.invalidate_caches()
+    assert not importer._misses
+
+    mod = load(importer, 'vfsimp_inval_mod')
+    assert mod.value == 4
+
+
+def test_newer_mount_shadows_older(tmpdir, mount_point):
+    mount(tmpdir, mount_point, 'old', {'vfsimp_shadow_mod.py': b'value = "old"\n'})
+    mount(tmpdir, mount_point, 'new', {'vfsimp_shadow_mod.py': b'value = "new"\n'})
+
+    importer = VFSImporter.VFSImporter(mount_point)
+    mod = load(importer, 'vfsimp_shadow_mod')
+    assert mod.value == "new"
+
+
+def test_implicit_pz(tmpdir, mount_point):
+    data = zlib.compress(b'value = 5\n')
+    mount(tmpdir, mount_point, 'a', {'vfsimp_pz_mod.py.pz': data})
+
+    importer = VFSImporter.VFSImporter(mount_point)
+    mod = load(importer, 'vfsimp_pz_mod')
+    assert mod.value == 5
+
+
+def test_implicit_mf(tmpdir):
+    # A multifile on the path that hasn't been mounted yet can't be
+    # listed, but it is mounted as soon as a file within it is requested.
+    mf_path = make_multifile(tmpdir, 'a', {'vfsimp_implicit_mod.py': b'value = 6\n'})
+    page = core.load_prc_file_data('', 'vfs-implicit-mf true')
+    try:
+        importer = VFSImporter.VFSImporter(mf_path)
+        mod = load(importer, 'vfsimp_implicit_mod')
+        assert mod.value == 6
+    finally:
+        core.unload_prc_file(page)
+        vfs.unmount_point(mf_path)
+
+
+def test_invalidate_caches_same_second(tmpdir):
+    importer = VFSImporter.VFSImporter(str(tmpdir))
+    assert importer.find_module('vfsimp_gen_mod') is None
+
+    # Pretend that the file was written within the same second as the
+    # failed lookup, so that the timestamp of the directory is unchanged.
+    mtime = os.path.getmtime(str(tmpdir))
+    tmpdir.join('vfsimp_gen_mod.py').write('value = 8\n')
+    os.utime(str(tmpdir), (mtime, mtime))
+    assert importer.find_module('vfsimp_gen_mod') is None
+
+    VFSImporter.invalidate_caches()
+    mod = load(importer, 'vfsimp_gen_mod')
+    assert mod.value == 8
+
+
+def test_misses_bounded(tmpdir):
+    importer = VFSImporter.VFSImporter(str(tmpdir))
+    num_names = VFSImporter._MAX_MISSES + 100
+    for i in range(num_names):
+        assert importer.find_module('vfsimp_missing_%d' % (i)) is None
+        assert len(importer._misses) <= VFSImporter._MAX_MISSES
+
+    # The most recently looked-up name must still be remembered.
+    assert 'vfsimp_missing_%d' % (num_names - 1) in importer._misses
+
+
+def test_sourceless_pyc(tmpdir):
+    # The .pyc file is written in the format of this Python version by
+    # the standard library, as compileall would write it.
+    source = tmpdir.join('vfsimp_nosrc_mod.py')
+    source.write('value = 11\n')
+    pyc = tmpdir.join('vfsimp_nosrc_mod.pyc')
+    py_compile.compile(str(source), cfile=str(pyc), doraise=True)
+    source.remove()
+
+    importer = VFSImporter.VFSImporter(str(tmpdir))
+    loader = importer.find_module('vfsimp_nosrc_mod')
+    assert loader.get_filename('vfsimp_nosrc_mod') == str(pyc)
+    assert loader.get_source('vfsimp_nosrc_mod') is None
+    assert load(importer, 'vfsimp_nosrc_mod').value == 11
+
+
+def test_fresh_pyc_used(tmpdir, monkeypatch):
+    # Compiling this would make a hash-based .pyc on Python 3.7.
+    monkeypatch.delenv('SOURCE_DATE_EPOCH', raising=False)
+
+    # Put different code in the .pyc file than in the source file, so we
+    # can tell which one was loaded.
+    other = tmpdir.join('vfsimp_fresh_other.py')
+    other.write('value = "pyc"\n')
+    py_compile.compile(str(other), cfile=str(tmpdir.join('vfsimp_fresh_mod.pyc')),
+                       doraise=True)
+
+    # The .pyc file records the timestamp of the other source file.
+    source = tmpdir.join('vfsimp_fresh_mod.py')
+    source.write('value = "py"\n')
+    mtime = os.path.getmtime(str(other))
+    os.utime(str(source), (mtime, mtime))
+
+    importer = VFSImporter.VFSImporter(str(tmpdir))
+    assert load(importer, 'vfsimp_fresh_mod').value == "pyc"
+
+
+@pytest.mark.parametrize("data", [
+    b'',
+    VFSImporter._PYC_MAGIC[:2],
+    VFSImporter._PYC_MAGIC + b'\0\0',
+    b'junk' * 8,
+])
+def test_bad_pyc_ignored(tmpdir, data):
+    source = tmpdir.join('vfsimp_bad_mod.py')
+    source.write('value = 12\n')
+    pyc = tmpdir.join('vfsimp_bad_mod.pyc')
+    pyc.write_binary(data)
+
+    # Make sure the .pyc file doesn't appear to be out of date.
+    mtime = os.path.getmtime(str(source)) + 10
+    os.utime(str(pyc), (mtime, mtime))
+
+    importer = VFSImporter.VFSImporter(str(tmpdir))
+    assert load(importer, 'vfsimp_bad_mod').value == 12
+
+    # It should have been replaced by a good one.
+    assert pyc.read_binary()[:4] == VFSImporter._PYC_MAGIC
+    assert load(importer, 'vfsimp_bad_mod').value == 12
+
+
+def test_source_without_newline(tmpdir):
+    tmpdir.join('vfsimp_nonl_mod.py').write('value = 10')
+    importer = VFSImporter.VFSImporter(str(tmpdir))
+    loader = importer.find_module('vfsimp_nonl_mod')
+    assert loader.get_source('vfsimp_nonl_mod') == 'value = 10'
+    assert load(importer, 'vfsimp_nonl_mod').value == 10
+
+
+def test_package_init_added_later(tmpdir):
+    pkg = tmpdir.mkdir('vfsimp_late_pkg')
+    importer = VFSImporter.VFSImporter(str(tmpdir))
+    assert importer.find_module('vfsimp_late_pkg') is None
+
+    # This doesn't change the timestamp of tmpdir, only that of pkg.
+    pkg.join('__init__.py').write('value = 7\n')
+    mod = load(importer, 'vfsimp_late_pkg')
+    assert mod.value == 7
+
+
+def test_reload_edited_source(tmpdir):
+    path = tmpdir.join('vfsimp_edit_mod.py')
+    path.write('value = 1\n')
+    importer = VFSImporter.VFSImporter(str(tmpdir))
+    assert load(importer, 'vfsimp_edit_mod').value == 1
+
+    # Make sure the new timestamp differs from the old one.
+    path.write('value = 2\n')
+    mtime = os.path.getmtime(str(path)) + 10
+    os.utime(str(path), (mtime, mtime))
+
+    assert load(importer, 'vfsimp_edit_mod').value == 2
+
+    # No temporary files should be left over from writing the .pyc.
+    assert not [p for p in tmpdir.listdir() if p.basename.endswith('.tmp')]
+
+
+def test_meta_finder_string_path():
+    # Python 2 sets the __path__ of a frozen package to its own name.
+    finder = VFSImporter.VFSMetaFinder()
+    assert finder.find_module('vfsimp_frozen.child', 'vfsimp_frozen') is None
+    assert 'v' not in sys.path_importer_cache
+
+
+def reject_all(path):
+    raise ImportError
+
+
+def test_meta_finder(tmpdir, mount_point, monkeypatch):
+    mount(tmpdir, mount_point, 'a', {'vfsimp_meta_mod.py': b'value = 13\n'})
+    empty = str(tmpdir.mkdir('empty'))
+    monkeypatch.setattr(sys, 'path', [empty, mount_point.to_os_specific()])
+    monkeypatch.setattr(sys, 'path_hooks', [reject_all, VFSImporter.VFSImporter])
+    monkeypatch.setattr(sys, 'path_importer_cache', {})
+
+    finder = VFSImporter.VFSMetaFinder()
+    assert load(finder, 'vfsimp_meta_mod').value == 13
+    assert isinstance(sys.path_importer_cache[empty], VFSImporter.VFSImporter)
+
+
+def test_meta_finder_defers(tmpdir, mount_point, monkeypatch):
+    mount(tmpdir, mount_point, 'a', {'vfsimp_defer_mod.py': b'value = 14\n'})
+    other = str(tmpdir.mkdir('other'))
+    monkeypatch.setattr(sys, 'path', [other, mount_point.to_os_specific()])
+    monkeypatch.setattr(sys, 'path_hooks', [VFSImporter.VFSImporter])
+
+    # The first entry is handled by some other importer, which must get
+    # to look for the module first; only Python itself can ask it.
+    monkeypatch.setattr(sys, 'path_importer_cache', {other: object()})
+
+    finder = VFSImporter.VFSMetaFinder()
+    assert finder.find_module('vfsimp_defer_mod') is None
+    assert mount_point.to_os_specific() not in sys.path_importer_cache
+
+
+@pytest.mark.skipif(sys.version_info < (3, 0),
+                    reason="Python 2 doesn't resolve '' to the cwd")
+def test_meta_finder_empty_path_entry(tmpdir, monkeypatch):
+    tmpdir.join('vfsimp_cwd_mod.py').write('value = 9\n')
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setattr(sys, 'path', [''])
+    monkeypatch.setattr(sys, 'path_hooks', [VFSImporter.VFSImporter])
+    monkeypatch.setattr(sys, 'path_importer_cache', {})
+
+    finder = VFSImporter.VFSMetaFinder()
+    loader = finder.find_module('vfsimp_cwd_mod')
+    assert loader is not None
+    filename = os.path.join(os.getcwd(), 'vfsimp_cwd_mod.py')
+    assert loader.get_filename('vfsimp_cwd_mod') == filename
+    assert '' not in sys.path_importer_cache
+
+
+
+def extension_module_file():
+    """ Returns the filename of an extension module from the standard
+    library that nothing else is likely to be using. """
+    try:
+        f, filename, desc = imp.find_module('audioop')
+    except ImportError:
+        pytest.skip("audioop is not available")
+    if f:
+        f.close()
+    if desc[2] != imp.C_EXTENSION:
+        pytest.skip("audioop is not an extension module")
+    return filename
+
+
+@pytest.fixture
+def extension_module(tmpdir, mount_point):
+    """ Mounts a copy of an extension module from the standard library
+    on mount_point, and returns its name. """
+    filename = extension_module_file()
+    with open(filename, 'rb') as f:
+        data = f.read()
+    mount(tmpdir, mount_point, 'a', {os.path.basename(filename): data})
+
+    # Loading the extension replaces any audioop module in sys.modules,
+    # or on Python 2, modifies it in place.  Keep it out of the way.
+    saved = sys.modules.pop('audioop', None)
+    yield 'audioop'
+    sys.modules.pop('audioop', None)
+    if saved is not None:
+        sys.modules['audioop'] = saved
+
+
+def test_extension_extracted_once(mount_point, extension_module):
+    importer = VFSImporter.VFSImporter(mount_point)
+    before = set(VFSImporter._extractedModules)
+
+    loader = importer.find_module(extension_module)
+    mod = loader.load_module(extension_module)
+    assert mod.__file__ == loader.get_filename(extension_module)
+
+    keys = set(VFSImporter._extractedModules) - before
+    assert len(keys) == 1
+    key = keys.pop()
+    extracted = VFSImporter._extractedModules[key]
+    assert extracted.exists()
+
+    # Loading it again should reuse the same file.
+    importer.find_module(extension_module).load_module(extension_module)
+    assert set(VFSImporter._extractedModules) - before == set([key])
+    assert VFSImporter._extractedModules[key] == extracted
+
+
+@pytest.mark.skipif(sys.platform == 'win32',
+                    reason="temporary files don't honor TMPDIR on Windows")
+def test_extension_failed_copy(tmpdir, mount_point, extension_module,
+                               monkeypatch):
+    temp = tmpdir.mkdir('temp')
+    monkeypatch.setenv('TMPDIR', str(temp))
+    monkeypatch.setattr(VFSImporter, 'copyStream', lambda sin, sout: False)
+    before = dict(VFSImporter._extractedModules)
+
+    importer = VFSImporter.VFSImporter(mount_point)
+    loader = importer.find_module(extension_module)
+    with pytest.raises(IOError):
+        loader.load_module(extension_module)
+
+    # The partial copy should have been removed, and not remembered.
+    assert not temp.listdir()
+    assert VFSImporter._extractedModules == before